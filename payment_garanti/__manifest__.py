@@ -12,7 +12,7 @@
     " kredi kartı ile ödeme alınabilmesi için oluşturulan güvenli"
     " bir ödeme çözümüdür.",
     "depends": ["payment"],
-    "external_dependencies": {"python": ["lxml", "beautifulsoup4"]},
+    "external_dependencies": {"python": ["lxml"]},
     "data": [
         "security/ir.model.access.csv",
         "views/payment_provider_error_views.xml",
@@ -11,3 +11,17 @@ CURRENCY_CODES = {
     "EUR": "978",
     "GBP": "826",
 }
+
+# Parameters sent unchanged with every 3D payment request.
+PAYMENT_STATIC_VALS = {
+    "refreshtime": "0",
+    "paymenttype": "creditcard",
+    "secure3dsecuritylevel": "3D",
+    "txntype": "sales",
+    "apiversion": "16",
+    "txninstallmentcount": "",  # Taksit yok. Boş olacak.
+    "txntimeoutperiod": 60,
+    "addcampaigninstallment": "N",
+    "totalinstallmentcount": "0",
+    "installmentonlyforcommercialcard": "N",
+}
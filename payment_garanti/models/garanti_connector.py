@@ -1,28 +1,49 @@
 # Copyright 2022 Yiğit Budak (https://github.com/yibudak)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl)
 
+from decimal import Decimal, ROUND_HALF_UP
+from http.cookiejar import DefaultCookiePolicy
 from lxml import etree
-from bs4 import BeautifulSoup
+from lxml import html as lxml_html
 from hashlib import sha1
 from odoo.exceptions import ValidationError
-from odoo.addons.payment_garanti.const import PROVISION_URL
+from odoo.addons.payment_garanti.const import PROVISION_URL, PAYMENT_STATIC_VALS
 from odoo import _
+from requests.adapters import HTTPAdapter
 import requests
 import time
 
+# Shared between connectors (and threads) so the HTTPS connections to Garanti
+# are kept alive between requests. Cookies must never be carried over from one
+# customer's payment to another, so the jar refuses to store any.
+_session = requests.Session()
+_session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
 
 class GarantiConnector:
     def __init__(self, provider, tx, amount, currency, card_args=None, client_ip=None):
         self.endpoint = provider._garanti_get_api_url()
+        self.mode = provider._garanti_get_mode()
+        self.return_url = provider._garanti_get_return_url()
         self.provider = provider
         self.tx = tx
-        self.amount = int(
-            round(amount * 100, 0)
-        )  # Garanti API expects amount in kuruş.
+        self.amount = self._get_amount(amount)
         self.currency = currency
         self.card_args = card_args
         self.client_ip = client_ip
 
+    @staticmethod
+    def _get_amount(amount):
+        """Garanti API expects amount in kuruş, rounded half up.
+
+        :param amount: Amount in the currency unit
+        :return: Amount in minor units
+        """
+        return int(
+            (Decimal(str(amount)) * 100).quantize(Decimal("1"), rounding=ROUND_HALF_UP)
+        )
+
     @property
     def reference(self):
         """
@@ -41,15 +62,26 @@ class GarantiConnector:
         :param response: Response
         :return: Response HTML
         """
-        soup = BeautifulSoup(response.text, "html.parser")
-        error_msg = soup.find("input", {"name": "mderrormessage"})
+        try:
+            parser = lxml_html.HTMLParser(encoding=response.encoding)
+        except LookupError:
+            # Unknown charset in Content-Type, let lxml detect the encoding.
+            parser = lxml_html.HTMLParser()
+        try:
+            root = lxml_html.fromstring(response.content, parser=parser)
+        except (etree.ParserError, ValueError, LookupError):
+            return "redirect", response.text
+
+        error_msg = root.xpath('//input[@name="mderrormessage"]/@value')
         if error_msg:
-            raise ValidationError(error_msg["value"])
+            raise ValidationError(error_msg[0])
 
-        form = soup.find("form", {"id": "webform0"})
+        form = root.xpath('//form[@id="webform0"]')
 
         if form:
-            return "form", str(form)
+            return "form", lxml_html.tostring(
+                form[0], encoding="unicode", with_tail=False
+            )
 
         # This means Garanti returned a redirection page. We need to follow it.
         else:
@@ -62,9 +94,7 @@ class GarantiConnector:
         """
         vals = self._garanti_create_payment_vals()
         try:
-            resp = requests.post(
-                self.provider._garanti_get_api_url(), params=vals, timeout=10
-            )
+            resp = _session.post(self.endpoint, params=vals, timeout=10)
             return self._garanti_parse_response_html(resp)
         except requests.RequestException:
             raise ValidationError(_("Payment Error. Please contact us."))
@@ -86,21 +116,20 @@ class GarantiConnector:
 
         :return: secure3dhash
         """
-        hash_strings = (
-            str(self.provider.garanti_terminal_id)
-            + str(self.reference)  # terminalID
-            + str(self.amount)  # orderid
-            + str(self.provider._garanti_get_return_url())  # txnamount
-            + str(self.provider._garanti_get_return_url())  # successurl
-            + "sales"  # errorurl
-            +  # txntype
-            # "" +  # txninstallmentcount
-            str(self.provider.garanti_store_key)
-            + str(self._garanti_compute_security_data())  # storekey  # securitydata
-        )
-        self.tx.garanti_secure3d_hash = (
-            sha1(hash_strings.encode("utf-8")).hexdigest().upper()
-        )
+        hash_obj = sha1()
+        for part in (
+            self.provider.garanti_terminal_id,  # terminalid
+            self.reference,  # orderid
+            self.amount,  # txnamount
+            self.return_url,  # successurl
+            self.return_url,  # errorurl
+            "sales",  # txntype
+            # "",  # txninstallmentcount
+            self.provider.garanti_store_key,  # storekey
+            self._garanti_compute_security_data(),  # securitydata
+        ):
+            hash_obj.update(str(part).encode("utf-8"))
+        self.tx.garanti_secure3d_hash = hash_obj.hexdigest().upper()
         return self.tx.garanti_secure3d_hash
 
     def _garanti_get_partner_lang(self):
@@ -115,22 +144,16 @@ class GarantiConnector:
         :return: Parameters
         """
         return {
-            "refreshtime": "0",
-            "paymenttype": "creditcard",
-            "secure3dsecuritylevel": "3D",
-            "txntype": "sales",
+            **PAYMENT_STATIC_VALS,
             "cardname": self.card_args.get("card_name"),
             "cardnumber": self.provider._garanti_format_card_number(
                 self.card_args.get("card_number")
             ),
             "cardexpiredatemonth": self.card_args.get("card_valid_month").zfill(2),
-            "cardexpiredateyear": self.card_args.get("card_valid_year").replace(
-                "20", ""
-            ),
+            "cardexpiredateyear": (self.card_args.get("card_valid_year") or "")[-2:],
             "cardcvv2": self.card_args.get("card_cvv"),
             "companyname": self.provider._garanti_get_company_name(),
-            "apiversion": "16",
-            "mode": self.provider._garanti_get_mode(),
+            "mode": self.mode,
             "terminalprovuserid": self.provider.garanti_prov_user,
             "terminaluserid": self.provider.garanti_terminal_id,
             "terminalid": self.provider.garanti_terminal_id,
@@ -140,15 +163,10 @@ class GarantiConnector:
             "customeripaddress": self.client_ip,
             "txnamount": str(self.amount),
             "txncurrencycode": self.provider._garanti_get_currency_code(self.currency),
-            "txninstallmentcount": "",  # Taksit yok. Boş olacak.
-            "successurl": self.provider._garanti_get_return_url(),
-            "errorurl": self.provider._garanti_get_return_url(),
+            "successurl": self.return_url,
+            "errorurl": self.return_url,
             "lang": self._garanti_get_partner_lang(),
-            "txntimestamp": round(time.time() * 1000),
-            "txntimeoutperiod": 60,
-            "addcampaigninstallment": "N",
-            "totalinstallmentcount": "0",
-            "installmentonlyforcommercialcard": "N",
+            "txntimestamp": time.time_ns() // 1_000_000,
             "secure3dhash": self._garanti_create_secure3d_hash(),
         }
 
@@ -285,7 +303,7 @@ class GarantiConnector:
         gvps_request = etree.Element("GVPSRequest")
 
         mode = etree.SubElement(gvps_request, "Mode")
-        mode.text = self.provider._garanti_get_mode()
+        mode.text = self.mode
 
         version = etree.SubElement(gvps_request, "Version")
         version.text = "16"
@@ -311,7 +329,7 @@ class GarantiConnector:
         self.notification_data = notification_data
         xml_data = self._garanti_create_callback_xml()
         try:
-            resp = requests.post(
+            resp = _session.post(
                 PROVISION_URL, data=xml_data.decode("utf-8"), timeout=10
             )
         except requests.RequestException:
@@ -319,10 +337,11 @@ class GarantiConnector:
 
         try:
             root = etree.fromstring(resp.content)
-            reason_code = root.find(".//Transaction/Response/ReasonCode").text
-            message = root.find(".//Transaction/Response/Message").text
+            response = root.find(".//Transaction/Response")
+            reason_code = response.find("ReasonCode").text
+            message = response.find("Message").text
             if reason_code != "00" or message != "Approved":
-                return root.find(".//Transaction/Response/ErrorMsg").text
+                return response.find("ErrorMsg").text
             else:
                 return message
         except Exception:  # pylint: disable=broad-except